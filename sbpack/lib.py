@@ -1,9 +1,15 @@
 from typing import Union, Optional
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from urllib.parse import ParseResult, urlparse, urljoin
-from urllib.request import urlopen
+from urllib.request import Request, urlopen
 from urllib.error import HTTPError
+import hashlib
+import json
 import pathlib
+import os
+import pickle
 import sys
 
 import sevenbridges as sbg
@@ -14,6 +20,26 @@ from ruamel.yaml.parser import ParserError
 from ruamel.yaml.scanner import ScannerError
 from ruamel.yaml import YAML
 fast_yaml = YAML(typ="safe")
+try:
+    import _ruamel_yaml  # noqa: F401
+    has_libyaml = True
+except ImportError:
+    has_libyaml = False
+
+# Loader used for linked files. SBPACK_YAML_BACKEND=pyyaml switches to PyYAML's
+# CSafeLoader. This is opt-in because PyYAML implements YAML 1.1, where
+# unquoted values such as "on", "off", "yes" and "no" are read as booleans.
+yaml_backend = os.getenv("SBPACK_YAML_BACKEND", "ruamel")
+yaml_load = fast_yaml.load
+yaml_parser_errors = (ParserError,)
+yaml_scanner_errors = (ScannerError,)
+if yaml_backend == "pyyaml":
+    import yaml
+    has_libyaml = hasattr(yaml, "CSafeLoader")
+    yaml_load = partial(
+        yaml.load, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    yaml_parser_errors += (yaml.parser.ParserError,)
+    yaml_scanner_errors += (yaml.scanner.ScannerError,)
 
 
 class MissingTypeName(BaseException):
@@ -103,6 +129,7 @@ def normalized_path(link: str, base_url: ParseResult):
     return new_url
 
 
+@lru_cache(maxsize=4096)
 def resolved_path(base_url: ParseResult, link: str):
     """
     Given a base_url ("this document") and a link ("string in this document")
@@ -126,8 +153,11 @@ def resolved_path(base_url: ParseResult, link: str):
             if link == "":
                 new_url = base_url
             else:
+                # Join lexically, like URLs; Path.resolve() would stat every
+                # component to follow symbolic links
                 new_url = base_url._replace(
-                    path=str((pathlib.Path(base_url.path).parent / pathlib.Path(link)).resolve())
+                    path=os.path.abspath(
+                        os.path.join(os.path.dirname(base_url.path), link))
                 )
 
         else:
@@ -143,18 +173,109 @@ def resolved_path(base_url: ParseResult, link: str):
     return new_url
 
 
+@lru_cache(maxsize=4096)
+def url_string(url: ParseResult):
+    """
+    Cached url.geturl(). The same few document urls are turned back into
+    strings for every link and type reference found in them, and
+    reassembling a ParseResult costs several times more than a cache hit.
+    """
+    return url.geturl()
+
+
+def naive_deepcopy(obj):
+    """
+    Copy a document made of plain dicts, lists and scalars, which is all the
+    safe YAML loader produces. Much cheaper than copy.deepcopy because it
+    skips the memo dict and the generic reduce machinery.
+    """
+    _type = type(obj)
+    if _type is dict:
+        return {k: naive_deepcopy(v) for k, v in obj.items()}
+    if _type is list:
+        return [naive_deepcopy(v) for v in obj]
+    return obj
+
+
+# Parsed linked files keyed by (resolved url, is_import), so that a file
+# referenced from many places is fetched and parsed only once.
+# sbpack.pack.pack() replaces it at the start of every packing run.
+# Documents are kept pickled: callers modify what they get in place, and
+# unpickling a fresh copy is cheaper than deep copying a pristine one.
+linked_file_cache = {}
+
+# Directory keeping remote files between runs, revalidated with the server
+# on every use. Off (None) unless set through sbpack.pack.pack(cache_dir=...)
+remote_cache_dir = None
+
+# Number of remote files fetched in parallel by prefetch_linked_files.
+# 1 or less fetches them one by one. Set by sbpack.pack.pack(jobs=...)
+prefetch_jobs = 16
+
+
 def load_linked_file(base_url: ParseResult, link: str, is_import=False):
 
     new_url = resolved_path(base_url, link)
 
+    key = (url_string(new_url), is_import)
+    if key not in linked_file_cache:
+        linked_file_cache[key] = _cache_entry(
+            _load_linked_file(new_url, is_import))
+
+    _node, new_url = linked_file_cache[key]
+    return pickle.loads(_node), new_url
+
+
+def _cache_entry(loaded: tuple):
+    _node, new_url = loaded
+    return pickle.dumps(_node, pickle.HIGHEST_PROTOCOL), new_url
+
+
+def prefetch_linked_files(links: list, max_workers=16):
+    """
+    Fetch remote linked files in parallel and store them in the linked file
+    cache, so that the following load_linked_file calls do not wait on the
+    network one after the other. `links` holds (base_url, link, is_import)
+    tuples. Local files are left to the regular load. Errors are ignored
+    here and reported when the file is loaded for real.
+    """
+    urls = {}
+    for base_url, link, is_import in links:
+        new_url = resolved_path(base_url, link)
+        key = (url_string(new_url), is_import)
+        if new_url.scheme in ["file://", ""] or key in linked_file_cache:
+            continue
+        urls[key] = new_url
+
+    if len(urls) < 2:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        futures = {
+            key: executor.submit(_load_linked_file, new_url, key[1])
+            for key, new_url in urls.items()
+        }
+        for key, future in futures.items():
+            try:
+                linked_file_cache[key] = _cache_entry(future.result())
+            except (Exception, SystemExit):
+                pass
+
+
+def _load_linked_file(new_url: ParseResult, is_import: bool):
+
     if new_url.scheme in ["file://", ""]:
-        contents = pathlib.Path(new_url.path).open().read()
-    else:
-        try:
-            contents = urlopen(new_url.geturl()).read().decode("utf-8")
-        except HTTPError as e:
-            e.msg += f"\n===\nCould not find linked file: {new_url.geturl()}\n===\n"
-            raise SystemExit(e)
+        with pathlib.Path(new_url.path).open() as f:
+            # Hand the open file to the parser so the document is parsed as
+            # it is read, without holding the whole text in memory as well
+            _node = _parse_linked_file(f, new_url) if is_import else f.read()
+        return _node, new_url
+
+    try:
+        contents = _fetch_remote_file(new_url.geturl())
+    except HTTPError as e:
+        e.msg += f"\n===\nCould not find linked file: {new_url.geturl()}\n===\n"
+        raise SystemExit(e)
 
     if _is_github_symbolic_link(new_url, contents):
         # This is an exception for symbolic links on github
@@ -164,21 +285,72 @@ def load_linked_file(base_url: ParseResult, link: str, is_import=False):
         return load_linked_file(new_url, contents, is_import=is_import)
 
     if is_import:
-        try:
-            _node = fast_yaml.load(contents)
-        except ParserError as e:
-            e.context = f"\n===\nMalformed file: {new_url.geturl()}\n===\n" + e.context
-            raise SystemExit(e)
-        except ScannerError as e:
-            e.problem = f"\n===\nMalformed file: {new_url.geturl()}\n===\n" + e.problem
-            raise SystemExit(e)
-
+        _node = _parse_linked_file(contents, new_url)
     else:
         _node = contents
 
     return _node, new_url
 
 
+def _fetch_remote_file(url: str):
+    if remote_cache_dir is None:
+        with urlopen(url) as response:
+            return response.read().decode("utf-8")
+
+    cache_path = pathlib.Path(remote_cache_dir) / \
+        f"{hashlib.sha1(url.encode()).hexdigest()}.json"
+    request = Request(url)
+    cached = None
+    if cache_path.is_file():
+        try:
+            cached = json.loads(cache_path.read_text())
+        except ValueError:
+            pass
+    if cached is not None:
+        if cached.get("etag"):
+            request.add_header("If-None-Match", cached["etag"])
+        if cached.get("last_modified"):
+            request.add_header("If-Modified-Since", cached["last_modified"])
+
+    try:
+        with urlopen(request) as response:
+            contents = response.read().decode("utf-8")
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except HTTPError as e:
+        if e.code == 304 and cached is not None:
+            return cached["contents"]
+        raise
+
+    if etag or last_modified:
+        # Without a validator the file could never be revalidated
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps({
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "contents": contents,
+            }))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            sys.stderr.write(f"Could not cache {url}: {e}\n")
+
+    return contents
+
+
+def _parse_linked_file(stream, new_url: ParseResult):
+    try:
+        return yaml_load(stream)
+    except yaml_parser_errors as e:
+        e.context = f"\n===\nMalformed file: {new_url.geturl()}\n===\n" + e.context
+        raise SystemExit(e)
+    except yaml_scanner_errors as e:
+        e.problem = f"\n===\nMalformed file: {new_url.geturl()}\n===\n" + e.problem
+        raise SystemExit(e)
+
+
 def _is_github_symbolic_link(base_url: ParseResult, contents: str):
     """Look for remote path with contents that is a single line with no new
     line with an extension."""
@@ -195,6 +367,7 @@ def _is_github_symbolic_link(base_url: ParseResult, contents: str):
     return True
 
 
+@lru_cache(maxsize=None)
 def get_profile(profile):
     if profile == ".":
         api = sbg.Api()
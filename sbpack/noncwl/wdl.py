@@ -1,12 +1,13 @@
 import json
 import yaml
 import os
+import hashlib
 import sbpack.lib as lib
 import argparse
 import logging
 from sbpack.version import __version__
 import re
-from subprocess import check_call
+import subprocess
 from sbpack.noncwl.utils import (
     zip_and_push_to_sb,
     install_or_upgrade_app,
@@ -26,24 +27,50 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 JAVA_EXE = os.getenv('SBPACK_WDL_JAVA_EXE', 'java')
+# Directory for cached womtool results. Off unless set here or through
+# --cache-dir, since the cache key only covers WDL files under the workflow
+# directory and not imports from outside it or from URLs
+WOMTOOL_CACHE_DIR = os.getenv('SBPACK_WDL_CACHE_DIR') or None
+
+# Type with optional attributes, e.g. "Int (optional, default = 1)"
+TYPE_ATTRIBUTES_RE = re.compile(r'([^(]*)(\((.*)\))?')
+# Item type of an array, e.g. "String" in "Array[String]"
+ARRAY_ITEMS_RE = re.compile(r'\[(.*?)]')
+
+# WDL primitive types that map to lowercase CWL types
+LOWERCASE_TYPES = frozenset([
+    'String', 'Int', 'Float', 'Boolean',
+    'String?', 'Int?', 'Float?', 'Boolean?',
+])
 
 
 class SBWDLWrapper:
     def __init__(self, workflow_path, entrypoint, dump_schema=False,
-                 sb_doc=None, wdl_input=None, womtool_path=None):
+                 sb_doc=None, wdl_input=None, womtool_path=None,
+                 cache_dir=WOMTOOL_CACHE_DIR):
         self.sb_wrapper = dict()
         self.sb_package_id = None
         self.workflow_path = workflow_path
         self.entrypoint = entrypoint
         self.wdl_input = wdl_input
         self.womtool_path = womtool_path
+        self.cache_dir = cache_dir
         self.dump_schema = dump_schema
         self.sb_doc = sb_doc
+        self.readme_path = None
+
+    def get_readme_path(self):
+        """
+        Path to the README of the workflow, looked up only once
+        """
+        if self.readme_path is None:
+            self.readme_path = get_readme(self.workflow_path) or ''
+        return self.readme_path
 
     @staticmethod
     def parse_type(type_string):
-        t, _, attribute_string = re.search(r'([^(]*)(\((.*)\))?',
-                                           type_string).groups()
+        t, _, attribute_string = TYPE_ATTRIBUTES_RE.search(
+            type_string).groups()
         attribute_string = attribute_string \
             if attribute_string is not None else ''
 
@@ -66,44 +93,94 @@ class SBWDLWrapper:
     @staticmethod
     def womtool_type_mapper(t):
         # this allows for Files and other types to stay uppercase
-        primitive_types = ['String', 'Int', 'Float', 'Boolean']
-        if t in primitive_types or t in [elem+'?' for elem in primitive_types]:
-            t = t.lower()
-        return t
+        return t.lower() if t in LOWERCASE_TYPES else t
 
-    def generate_sb_inputs(self):
+    def womtool_cache_key(self):
         """
-        Generate SB inputs schema
+        Hash of the womtool jar and all WDL sources in the workflow directory.
+        Imports from outside the workflow directory are not covered
         """
-        womtool_inputs = self.wdl_input
-
-        if not womtool_inputs:
+        key = hashlib.sha256()
+        key.update(str(self.womtool_path).encode())
+        key.update(str(os.path.getmtime(self.womtool_path)).encode())
+        key.update(self.entrypoint.encode())
+        wdl_files = []
+        for root, _, files in os.walk(self.workflow_path):
+            wdl_files.extend(
+                os.path.join(root, f) for f in files if f.endswith('.wdl')
+            )
+        for wdl_file in sorted(wdl_files):
+            key.update(
+                os.path.relpath(wdl_file, self.workflow_path).encode()
+            )
+            with open(wdl_file, 'rb') as f:
+                key.update(f.read())
+        return key.hexdigest()
 
-            wdl_path = f'{self.workflow_path}/{self.entrypoint}'
-            java_cmd = " ".join([
+    def run_womtool_inputs(self):
+        """
+        Run womtool inputs on the entrypoint. With cache_dir set, reuse a
+        cached result if neither the WDL sources nor womtool changed since
+        the last run
+        """
+        cache_path = None
+        if self.cache_dir:
+            cache_path = os.path.join(
+                self.cache_dir, f'{self.womtool_cache_key()}.json'
+            )
+            if os.path.isfile(cache_path):
+                logger.info(f'Using cached womtool inputs {cache_path}')
+                with open(cache_path, 'r') as f:
+                    return json.load(f)
+
+        wdl_path = f'{self.workflow_path}/{self.entrypoint}'
+        womtool = subprocess.run(
+            [
                 str(JAVA_EXE),
                 '-jar',
                 str(self.womtool_path),
                 'inputs',
                 str(wdl_path),
-                ">",
-                f"{self.workflow_path}/womtool_inputs.json"
-            ])
-            call_java_womtool = check_call(java_cmd, shell=True)
-            with open(f"{self.workflow_path}/womtool_inputs.json", 'r') as f:
-                womtool_inputs = json.load(f)
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True
+        )
+        womtool_inputs = json.loads(womtool.stdout)
+
+        if cache_path:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(f'{cache_path}.tmp', 'w') as f:
+                    f.write(womtool.stdout)
+                os.replace(f'{cache_path}.tmp', cache_path)
+            except OSError as e:
+                logger.warning(f'Could not cache womtool inputs: {e}')
+
+        return womtool_inputs
 
+    def generate_sb_inputs(self):
+        """
+        Generate SB inputs schema
+        """
+        womtool_inputs = self.wdl_input
+
+        if not womtool_inputs:
+            womtool_inputs = self.run_womtool_inputs()
+
+        parse_type = self.parse_type
+        type_mapper = self.womtool_type_mapper
+        array_items = ARRAY_ITEMS_RE.search
         cwl_inputs = list()
         for key, value in womtool_inputs.items():
-            typ, descr = self.parse_type(value)
-            if bool(re.search(r'\[(.*?)]', typ)):
-                typ_temp = self.womtool_type_mapper(
-                    re.search(r'\[(.*?)]', typ).groups()[0]
-                ) + '[]'
+            typ, descr = parse_type(value)
+            items = array_items(typ)
+            if items:
+                typ_temp = type_mapper(items.groups()[0]) + '[]'
                 if '?' in typ:
                     typ = typ_temp + '?'
             else:
-                typ = self.womtool_type_mapper(typ)
+                typ = type_mapper(typ)
 
             new_item = {
                 'id': key.replace('.', '_'),
@@ -162,9 +239,11 @@ class SBWDLWrapper:
             self.sb_wrapper['app_content'] = app_content
             if self.sb_doc:
                 self.sb_wrapper['doc'] = self.sb_doc
-            elif get_readme(self.workflow_path):
-                with open(get_readme(self.workflow_path), 'r') as f:
-                    self.sb_wrapper['doc'] = f.read()
+            else:
+                readme = self.get_readme_path()
+                if readme:
+                    with open(readme, 'r') as f:
+                        self.sb_wrapper['doc'] = f.read()
             return self.sb_wrapper
 
 
@@ -209,6 +288,13 @@ def main():
     parser.add_argument("--sb-schema", required=False,
                         help="Do not create new schema, use this schema file. "
                              "It is sb_wdl_schema in JSON or YAML format.")
+    parser.add_argument("--cache-dir", required=False,
+                        default=WOMTOOL_CACHE_DIR,
+                        help="Cache womtool inputs in this directory and "
+                             "reuse them while the .wdl files under "
+                             "--workflow-path and womtool are unchanged. "
+                             "Imports from outside --workflow-path are not "
+                             "tracked, so leave this off for such workflows.")
     args = parser.parse_args()
 
     # Preprocess CLI parameter values
@@ -241,7 +327,8 @@ def main():
         entrypoint=args.entrypoint,
         wdl_input=wom_input,
         womtool_path=wom_path,
-        sb_doc=sb_doc
+        sb_doc=sb_doc,
+        cache_dir=args.cache_dir
     )
 
     if args.sb_schema:
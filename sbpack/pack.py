@@ -16,9 +16,12 @@ import sys
 import pathlib
 import urllib.parse
 import urllib.request
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 import json
 import enum
+import warnings
 
 from ruamel.yaml import YAML
 from packaging import version
@@ -35,23 +38,33 @@ logger = logging.getLogger(__name__)
 
 fast_yaml = YAML(typ="safe")
 
+# Keys of the single-key nodes that pull in another file
+_IMPORT_KEYS = frozenset(["$import", "$include"])
 
-def get_inner_dict(cwl: dict, path: list):
-    if len(path) == 0:
-        return cwl
 
-    if isinstance(cwl, dict):
-        _v = cwl.get(path[0]["key"])
-        if _v is not None:
-            return get_inner_dict(_v, path[1:])
+def get_inner_dict(cwl: dict, path: list):
+    for step in path:
+        if isinstance(cwl, dict):
+            cwl = cwl.get(step["key"])
+            if cwl is None:
+                return None
+
+        elif isinstance(cwl, list):  # Going to assume this is a map expressed as list
+            cwl = next(
+                (
+                    _v for _v in cwl
+                    if isinstance(_v, dict)
+                    and _v.get(step["key_field"]) == step["key"]
+                ),
+                None,
+            )
+            if cwl is None:
+                return None
 
-    elif isinstance(cwl, list):  # Going to assume this is a map expressed as list
-        for _v in cwl:
-            if isinstance(_v, dict):
-                if _v.get(path[0]["key_field"]) == path[0]["key"]:
-                    return get_inner_dict(_v, path[1:])
+        else:
+            return None
 
-    return None
+    return cwl
 
 
 def pack_process(
@@ -60,13 +73,20 @@ def pack_process(
     cwl_version: str,
     parent_user_defined_types=None,
     add_ids: bool = False,
+    imports_resolved: bool = False,
 ):
     cwl = listify_everything(cwl)
     cwl = normalize_sources(cwl)
     cwl, user_defined_types = \
         load_schemadefs(cwl, base_url, parent_user_defined_types)
     cwl = resolve_schemadefs(cwl, base_url, user_defined_types)
-    cwl = resolve_imports(cwl, base_url)
+    if imports_resolved:
+        # Process embedded in a workflow whose imports were already resolved,
+        # only the types inlined into the ports above can hold new imports
+        for port in ["inputs", "outputs"]:
+            cwl[port] = resolve_imports(cwl[port], base_url)
+    else:
+        cwl = resolve_imports(cwl, base_url)
     cwl = resolve_steps(
         cwl,
         base_url,
@@ -112,6 +132,7 @@ def dictify_requirements(cwl: dict):
 
 
 def normalize_sources(cwl: dict):
+    """Strip the leading "#" from step input sources and output sources"""
     if cwl.get("class") != "Workflow":
         return cwl
 
@@ -121,43 +142,41 @@ def normalize_sources(cwl: dict):
 
         _inputs = _step.get("in")
         for k, _input in enumerate(_inputs):
-            if isinstance(_input, str):
-                _inputs[k] = _normalize(_input)
-            elif isinstance(_input, dict):
+            if isinstance(_input, dict):
                 _src = _input.get("source")
-                if isinstance(_src, str):
-                    _input["source"] = _normalize(_input["source"])
+                if isinstance(_src, str) and _src[:1] == "#":
+                    _input["source"] = _src[1:]
+            elif isinstance(_input, str) and _input[:1] == "#":
+                _inputs[k] = _input[1:]
 
     _outputs = cwl.get("outputs")
     for k, _output in enumerate(_outputs):
-        if isinstance(_output, str):
-            _outputs[k] = _normalize(_output)
-        elif isinstance(_output, dict):
+        if isinstance(_output, dict):
             _src = _output.get("outputSource")
-            if isinstance(_src, str):
-                _output["outputSource"] = _normalize(_output["outputSource"])
+            if isinstance(_src, str) and _src[:1] == "#":
+                _output["outputSource"] = _src[1:]
+        elif isinstance(_output, str) and _output[:1] == "#":
+            _outputs[k] = _output[1:]
 
     return cwl
 
 
-def _normalize(s):
-    if s.startswith("#"):
-        return s[1:]
-    else:
-        return s
-
-
 def load_schemadefs(cwl: dict, base_url: urllib.parse.ParseResult,
                     parent_user_defined_types=None):
     user_defined_types = schemadef.build_user_defined_type_dict(cwl, base_url)
     if parent_user_defined_types is not None:
-        user_defined_types.update(parent_user_defined_types)
-
-    cwl["requirements"] = [
-        req
-        for req in cwl.get("requirements", [])
-        if req.get("class") != "SchemaDefRequirement"
-    ]
+        # Chain instead of copying the parent's types into every step,
+        # parent definitions still take precedence
+        user_defined_types = ChainMap(
+            parent_user_defined_types, user_defined_types)
+
+    _requirements = cwl.get("requirements", [])
+    if any(req.get("class") == "SchemaDefRequirement" for req in _requirements):
+        cwl["requirements"] = [
+            req
+            for req in _requirements
+            if req.get("class") != "SchemaDefRequirement"
+        ]
 
     return cwl, user_defined_types
 
@@ -170,27 +189,87 @@ def resolve_schemadefs(cwl: dict, base_url: urllib.parse.ParseResult,
 
 
 def resolve_imports(cwl: dict, base_url: urllib.parse.ParseResult):
-    if isinstance(cwl, dict):
-        itr = cwl.items()
-    elif isinstance(cwl, list):
-        itr = [(n, v) for n, v in enumerate(cwl)]
-    else:
-        return cwl
+    # Walk the tree with an explicit stack, deeply nested documents would
+    # otherwise run into the recursion limit
+    stack = [cwl]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            itr = node.items()
+        elif isinstance(node, list):
+            itr = enumerate(node)
+        else:
+            continue
 
-    for k, v in itr:
-        if isinstance(v, dict):
-            if len(v) == 1:
-                _k = list(v.keys())[0]
-                if _k in ["$import", "$include"]:
-                    cwl[k], this_base_url = lib.load_linked_file(
+        for k, v in itr:
+            if isinstance(v, dict) and len(v) == 1:
+                _k = next(iter(v))
+                if _k in _IMPORT_KEYS:
+                    # Replacing the value of an existing key does not upset
+                    # the iteration over the dict
+                    node[k] = v = lib.load_linked_file(
                         base_url, v[_k], is_import=_k == "$import"
-                    )
+                    )[0]
 
-        cwl[k] = resolve_imports(cwl[k], base_url)
+            # Scalars can not hold imports, only descend into containers
+            if isinstance(v, (dict, list)):
+                stack.append(v)
 
     return cwl
 
 
+def _linked_files(cwl: Union[list, dict], base_url: urllib.parse.ParseResult):
+    """List the $import, $include and step run links found in a document"""
+    links = []
+    stack = [cwl]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if len(node) == 1:
+                _k = next(iter(node))
+                if _k in _IMPORT_KEYS and isinstance(node[_k], str):
+                    links += [(base_url, node[_k], _k == "$import")]
+                    continue
+            if isinstance(node.get("run"), str):
+                links += [(base_url, node["run"], True)]
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return links
+
+
+def prefetch(cwl: dict, base_url: urllib.parse.ParseResult, max_workers=16):
+    """
+    Walk the document and everything it links to, one level of links at a
+    time, fetching the remote files of each level in parallel. The packing
+    pass that follows then finds every remote file in the linked file cache,
+    so that K remote files cost about as many round trips as the workflow
+    is deep rather than K.
+    """
+    seen = set()
+    documents = [(cwl, base_url)]
+    while documents:
+        links = [
+            link for _cwl, _base_url in documents
+            for link in _linked_files(_cwl, _base_url)
+        ]
+        lib.prefetch_linked_files(links, max_workers=max_workers)
+
+        documents = []
+        for _base_url, link, is_import in links:
+            key = (lib.url_string(lib.resolved_path(_base_url, link)), is_import)
+            if not is_import or key in seen:
+                continue
+            seen.add(key)
+            try:
+                documents += [
+                    lib.load_linked_file(_base_url, link, is_import=True)
+                ]
+            except (Exception, SystemExit):
+                # Reported by the packing pass
+                continue
+
+
 def resolve_steps(
     cwl: dict,
     base_url: urllib.parse.ParseResult,
@@ -209,6 +288,7 @@ def resolve_steps(
         return cwl
 
     workflow_id = cwl.get("id", os.path.basename(base_url.path))
+    workflow_version = cwl.get("cwlVersion", cwl_version)
     for n, v in enumerate(cwl["steps"]):
         if isinstance(v, dict):
             sys.stderr.write(f"\n--\nRecursing into step {base_url.geturl()}:{v['id']}\n")
@@ -218,42 +298,38 @@ def resolve_steps(
                 v["run"], new_base_url = lib.load_linked_file(
                     base_url, _run, is_import=True
                 )
-                v["run"] = pack_process(
+                v["run"] = run = pack_process(
                     v["run"],
                     new_base_url,
-                    cwl.get("cwlVersion", cwl_version),
+                    workflow_version,
                     add_ids=add_ids,
                 )
-                if "id" not in v["run"] and add_ids:
-                    v["run"]["id"] = f"{workflow_id}@step_{v['id']}" \
-                                     f"@{os.path.basename(_run)}"
+                if "id" not in run and add_ids:
+                    run["id"] = f"{workflow_id}@step_{v['id']}" \
+                                f"@{os.path.basename(_run)}"
             else:
-                v["run"] = pack_process(
+                v["run"] = run = pack_process(
                     v["run"],
                     base_url,
-                    cwl.get("cwlVersion", cwl_version),
+                    workflow_version,
                     parent_user_defined_types,
                     add_ids=add_ids,
+                    imports_resolved=True,
                 )
-                if "id" not in v["run"] and add_ids:
-                    v["run"]["id"] = f"{workflow_id}@step_{v['id']}@run"
-            if "cwlVersion" in v["run"]:
-                parent_version = version.parse(
-                    cwl.get("cwlVersion", cwl_version).strip("v")
-                )
-                this_version = version.parse(v["run"]["cwlVersion"].strip("v"))
+                if "id" not in run and add_ids:
+                    run["id"] = f"{workflow_id}@step_{v['id']}@run"
+            if "cwlVersion" in run:
+                parent_version = version.parse(workflow_version.strip("v"))
+                this_version = version.parse(run["cwlVersion"].strip("v"))
                 if this_version > parent_version:
-                    cwl["cwlVersion"] = v["run"]["cwlVersion"]
+                    cwl["cwlVersion"] = workflow_version = run["cwlVersion"]
                     # not really enough, but hope for the best
 
-                if 'sbg:appVersion' not in v["run"]:
-                    v["run"]['sbg:appVersion'] = [cwl.get(
-                        "cwlVersion", cwl_version)]
-                else:
-                    version_ = cwl.get(
-                        "cwlVersion", cwl_version)
-                    if version_ not in v["run"]['sbg:appVersion']:
-                        v["run"]['sbg:appVersion'].append(version_)
+                app_version = run.get("sbg:appVersion")
+                if app_version is None:
+                    run["sbg:appVersion"] = [workflow_version]
+                elif workflow_version not in app_version:
+                    app_version.append(workflow_version)
 
     return cwl
 
@@ -268,12 +344,7 @@ def add_missing_requirements(cwl: dict):
             requirements += [{"class": _req_name}]
 
     if cwl.get("class") == "Workflow":
-        sub_worflow = False
-        for step in cwl["steps"]:
-            if step["run"]["class"] == "Workflow":
-                sub_worflow = True
-                break
-        if sub_worflow:
+        if any(step["run"]["class"] == "Workflow" for step in cwl["steps"]):
             _add_req("SubworkflowFeatureRequirement")
     return cwl
 
@@ -305,44 +376,32 @@ def filter_out_non_sbg_tags(cwl: Union[list, dict]):
 
 def get_git_info(cwl_path: str) -> str:
     import subprocess
-    import os
 
     source_str = cwl_path
 
     file_path_url = urllib.parse.urlparse(cwl_path)
     if file_path_url.scheme == "":
         source_path = pathlib.Path(cwl_path)
-        os.chdir(source_path.parent)
-        try:
-            origin = (
-                subprocess.check_output(
-                    ["git", "config", "--get", "remote.origin.url"]
-                )
-                .strip()
-                .decode()
-            )
-            fpath = (
-                subprocess.check_output(
-                    ["git", "ls-files", "--full-name", source_path.name]
-                )
-                .strip()
-                .decode()
-            )
-            changed = (
-                subprocess.check_output(
-                    ["git", "status", source_path.name, "-s"]
-                )
+        # Don't spawn git at all for files outside of a repository
+        if not any(
+            (parent / ".git").exists()
+            for parent in source_path.resolve().parents
+        ):
+            return source_str
+
+        def _git(*args):
+            return (
+                subprocess.check_output(["git", *args], cwd=source_path.parent)
                 .strip()
                 .decode()
             )
+
+        try:
+            origin = _git("config", "--get", "remote.origin.url")
+            fpath = _git("ls-files", "--full-name", source_path.name)
+            changed = _git("status", source_path.name, "-s")
             if changed == "":
-                tag = (
-                    subprocess.check_output(
-                        ["git", "describe", "--always"]
-                    )
-                    .strip()
-                    .decode()
-                )
+                tag = _git("describe", "--always")
             else:
                 tag = "(uncommitted file)"
             source_str = f"\nrepo: {origin}\nfile: {fpath}\ncommit: {tag}"
@@ -353,6 +412,10 @@ def get_git_info(cwl_path: str) -> str:
     return source_str
 
 
+# Translation table deleting the characters not allowed in an app id
+_ILLEGAL_APP_ID_CHARACTERS = str.maketrans("", "", ".!@#$%^&*()")
+
+
 class AppIdCheck(enum.IntEnum):
     VALID = 0
     PATH_ERROR = 1
@@ -364,15 +427,41 @@ def validate_id(app_id: str):
     if len(parts) != 3:
         return AppIdCheck.PATH_ERROR
 
-    illegal = set(".!@#$%^&*()")
-    if any((c in illegal) for c in parts[2]):
+    if parts[2].translate(_ILLEGAL_APP_ID_CHARACTERS) != parts[2]:
         return AppIdCheck.ILLEGAL_CHARACTERS
 
     return AppIdCheck.VALID
 
 
-def pack(cwl_path: str, filter_non_sbg_tags=False, add_ids=False):
+def pack(cwl_path: str, filter_non_sbg_tags=False, add_ids=False, cache=None,
+         jobs=16, cache_dir=None):
+    """
+    Pack the CWL document at cwl_path. Linked files are loaded once per run;
+    pass the same dict as `cache` to several calls to share loaded files
+    between them. Up to `jobs` remote files are fetched in parallel, set it
+    to 1 to fetch them one by one. With `cache_dir` set, remote files are
+    kept there and only downloaded again when the server reports a change.
+    """
     sys.stderr.write(f"Packing {cwl_path}\n")
+    if not lib.has_libyaml:
+        if lib.yaml_backend == "pyyaml":
+            warnings.warn(
+                "PyYAML was built without libyaml, falling back to the slower "
+                "pure Python YAML parser. Reinstall PyYAML with libyaml "
+                "available to speed up packing.",
+                RuntimeWarning)
+        else:
+            warnings.warn(
+                "ruamel.yaml C bindings not found, falling back to the slower "
+                "pure Python YAML parser. Install ruamel.yaml.clib (or "
+                "ruamel.yaml[libyaml] for ruamel.yaml >= 0.19) to speed up "
+                "packing.",
+                RuntimeWarning)
+    lib.linked_file_cache = {} if cache is None else cache
+    lib.remote_cache_dir = cache_dir
+    lib.prefetch_jobs = jobs
+    lib.resolved_path.cache_clear()
+    lib.url_string.cache_clear()
     file_path_url = urllib.parse.urlparse(cwl_path)
 
     cwl, full_url = lib.load_linked_file(
@@ -380,6 +469,8 @@ def pack(cwl_path: str, filter_non_sbg_tags=False, add_ids=False):
     if "$graph" in cwl:
         # assume already packed
         return cwl
+    if jobs > 1:
+        prefetch(cwl, full_url, max_workers=jobs)
     cwl = pack_process(cwl, full_url, cwl["cwlVersion"], add_ids=add_ids)
     if add_ids and "id" not in cwl:
         cwl["id"] = os.path.basename(file_path_url.path)
@@ -416,6 +507,17 @@ def main():
         action="store_true",
         help="Filter out custom tags that are not 'sbg:'"
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=16,
+        help="Number of remote files to fetch in parallel."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep remote files in this directory between runs and download "
+             "them again only when they change on the server."
+    )
 
     args = parser.parse_args()
 
@@ -430,14 +532,22 @@ def main():
         sys.stderr.write("Incorrect path for app id\n")
         return
 
-    cwl = pack(cwl_path, filter_non_sbg_tags=args.filter_non_sbg_tags)
-
     api = lib.get_profile(profile)
 
+    # Look the app up while packing, neither depends on the other
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        existing_app = executor.submit(api.apps.get, appid)
+        cwl = pack(
+            cwl_path,
+            filter_non_sbg_tags=args.filter_non_sbg_tags,
+            jobs=args.jobs,
+            cache_dir=args.cache_dir
+        )
+
     cwl["sbg:revisionNotes"] = f"Uploaded using sbpack v{__version__}.\n" \
                                f"Source: {get_git_info(cwl_path)}"
     try:
-        app = api.apps.get(appid)
+        app = existing_app.result()
         logger.debug(f"Creating revised app: {appid}")
         api.apps.create_revision(id=appid, raw=cwl, revision=app.revision + 1)
     except sbgerr.NotFound:
@@ -470,6 +580,17 @@ def _localpack(args):
         action="store_true",
         help="Filter out custom tags that are not 'sbg:'",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=16,
+        help="Number of remote files to fetch in parallel.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep remote files in this directory between runs and download "
+             "them again only when they change on the server.",
+    )
 
     args = parser.parse_args(args)
 
@@ -478,7 +599,9 @@ def _localpack(args):
     cwl = pack(
         cwl_path,
         filter_non_sbg_tags=args.filter_non_sbg_tags,
-        add_ids=args.add_ids
+        add_ids=args.add_ids,
+        jobs=args.jobs,
+        cache_dir=args.cache_dir
     )
     if args.json:
         json.dump(cwl, sys.stdout, indent=4)
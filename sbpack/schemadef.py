@@ -13,11 +13,14 @@ Only records and arrays can be defined (https://github.com/common-workflow-langu
 
 import sys
 import urllib.parse
-from copy import deepcopy
 from typing import Union
 
 import sbpack.lib
 
+# Membership is tested for every type string that gets inlined
+_BUILT_IN_TYPES = frozenset(sbpack.lib.built_in_types)
+
+
 def build_user_defined_type_dict(cwl: dict, base_url: urllib.parse.ParseResult):
     user_defined_types = {}
     # Check for `$import` directly under `requirements` so we can specially handle
@@ -60,13 +63,22 @@ def _build_user_defined_type_dict(
                            f"Schemadef types have to be a list\n"
                            f"Instead, got: {schema_list}")
 
+    # Fetch remote type files together, the loop below then reads them
+    # from the linked file cache in order
+    if sbpack.lib.prefetch_jobs > 1:
+        sbpack.lib.prefetch_linked_files([
+            (base_url, schema["$import"], True)
+            for schema in schema_list
+            if isinstance(schema, dict) and len(schema) == 1 and "$import" in schema
+        ], max_workers=sbpack.lib.prefetch_jobs)
+
     for schema in schema_list:
         if not isinstance(schema, dict):
             raise RuntimeError(f"In file {base_url.geturl()}: "
                                f"User type has to be a dict\n"
                                f"Instead, got: {schema}")
 
-        if len(schema.keys()) == 1 and list(schema.keys())[0] == "$import":
+        if len(schema) == 1 and "$import" in schema:
             type_definition_list, this_url = \
                 sbpack.lib.load_linked_file(base_url, schema["$import"], is_import=True)
             # This is always a list
@@ -112,14 +124,7 @@ def inline_types(
 
 
 def _inline_type(v, base_url, user_defined_types):
-    try:
-        _inline_type.type_name_uniq_id += 1
-    except AttributeError:
-        _inline_type.type_name_uniq_id = 1
-    try:
-        len(_inline_type.type_names)
-    except AttributeError:
-        _inline_type.type_names = set()
+    _inline_type.type_name_uniq_id += 1
 
     if isinstance(v, str):
 
@@ -136,7 +141,7 @@ def _inline_type(v, base_url, user_defined_types):
                     _inline_type(v[:-1], base_url, user_defined_types)
             ]
 
-        if v in sbpack.lib.built_in_types:
+        if v in _BUILT_IN_TYPES:
             return v
 
         if "#" not in v:
@@ -147,12 +152,12 @@ def _inline_type(v, base_url, user_defined_types):
             path_prefix = sbpack.lib.resolved_path(base_url, parts[0])
             path_suffix = parts[1]
 
-        path = f"{path_prefix.geturl()}#{path_suffix}"
+        path = f"{sbpack.lib.url_string(path_prefix)}#{path_suffix}"
 
         if path not in user_defined_types:
             raise RuntimeError(f"Could not find type '{path}' in {str(user_defined_types)}")
         else:
-            resolve_type = deepcopy(user_defined_types[path])
+            resolve_type = sbpack.lib.naive_deepcopy(user_defined_types[path])
             # resolve_type.pop("name", None) # Should work, but cwltool complains
             if "name" in resolve_type:
                 user_type_name = resolve_type["name"]
@@ -205,7 +210,7 @@ def _inline_type(v, base_url, user_defined_types):
             ]
             return v
 
-        elif _type in sbpack.lib.built_in_types:
+        elif isinstance(_type, str) and _type in _BUILT_IN_TYPES:
             return v
 
         else:
@@ -214,3 +219,8 @@ def _inline_type(v, base_url, user_defined_types):
 
     else:
         raise RuntimeError("Found a type sbpack can not understand")
+
+
+# Shared by all packing runs in the process, tests reset them between runs
+_inline_type.type_name_uniq_id = 0
+_inline_type.type_names = set()
@@ -5,40 +5,57 @@ from typing import Tuple, List
 import pathlib
 import sys
 
-import ruamel.yaml
-
 import sevenbridges.errors as sbgerr
 
 from .lib import get_profile
 from .version import __version__
-from cwlformat.formatter import stringify_dict
 
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-yaml = ruamel.yaml.YAML()
-
 
 class CWLProcess:
+    __slots__ = ("cwl", "file_path")
+
     def __init__(self, cwl: dict, file_path: pathlib.Path):
         self.cwl = cwl
         self.file_path = file_path
 
     def __str__(self):
+        from cwlformat.formatter import stringify_dict
         return stringify_dict(self.cwl)
 
     def save(self):
         self.file_path.parent.mkdir(parents=True, exist_ok=True)
-        self.file_path.write_text(stringify_dict(self.cwl))
+        with self.file_path.open("w") as f:
+            dump_cwl(self.cwl, f)
+
+
+def dump_cwl(cwl: dict, stream):
+    # Same output as cwlformat's stringify_dict, written straight to the
+    # stream instead of being built up as one string first
+    from cwlformat.formatter import format_node, yaml
+    yaml.dump(format_node(cwl, node_path=[]), stream)
 
 
 def explode(cwl: CWLProcess) -> List[CWLProcess]:
-    _processes = [cwl]
-    _cwl = cwl.cwl
-    if _cwl.get("class") == "Workflow":
+    _processes = []
+    # Depth first with an explicit stack, processes come out in the same
+    # order as before: each workflow followed by its steps' processes
+    _stack = [cwl]
+    while _stack:
+        cwl = _stack.pop()
+        _processes += [cwl]
+        _cwl = cwl.cwl
+        if _cwl.get("class") != "Workflow":
+            continue
+
         sanitize_id(_cwl)
+        _parent = cwl.file_path.parent
+        _steps_dir = pathlib.Path(cwl.file_path.name + ".steps")
+        _children = []
         _cwl_steps = _cwl.get("steps", {})
         _is_dict = isinstance(_cwl_steps, dict)
         for _k, _step in (_cwl_steps.items() if _is_dict else enumerate(_cwl_steps)):
@@ -46,12 +63,10 @@ def explode(cwl: CWLProcess) -> List[CWLProcess]:
             if _step_id is not None:
                 _run = _step.get("run")
                 if isinstance(_run, dict):
-                    step_path = \
-                        cwl.file_path.parent / \
-                        (cwl.file_path.name + ".steps") / \
-                        (_step_id + ".cwl")
-                    _step["run"] = str(step_path.relative_to(cwl.file_path.parent))
-                    _processes += explode(CWLProcess(_run, step_path))
+                    step_path = _steps_dir / (_step_id + ".cwl")
+                    _step["run"] = str(step_path)
+                    _children += [CWLProcess(_run, _parent / step_path)]
+        _stack += reversed(_children)
 
     return _processes
 
@@ -59,8 +74,7 @@ def explode(cwl: CWLProcess) -> List[CWLProcess]:
 def sanitize_id(cwl: dict):
     # cwltool bug: https://github.com/common-workflow-language/cwltool/issues/1280
     if "id" in cwl:
-        cwl["sbg:original_source"] = cwl["id"]
-        cwl.pop("id")
+        cwl["sbg:original_source"] = cwl.pop("id")
 
 
 def main():
@@ -90,7 +104,8 @@ def main():
     fp_out = pathlib.Path(args.outname).absolute()
     if not args.unpack:
         sys.stderr.write(f"Saving {args.appid} to {fp_out}\n")
-        fp_out.write_text(stringify_dict(as_dict))
+        with fp_out.open("w") as f:
+            dump_cwl(as_dict, f)
         return 0
 
     for n, exploded in enumerate(explode(CWLProcess(as_dict, fp_out))):
@@ -1,18 +1,18 @@
 #  Copyright (c) 2020 Seven Bridges. See LICENSE
 
 import pathlib
-import os
 from datetime import datetime
 from setuptools import setup, find_packages
 
 current_path = pathlib.Path(__file__).parent
 
 name = "sbpack"
-version = open("sbpack/version.py").read().split("=")[1].strip().strip("\"")
+version = pathlib.Path(current_path, "sbpack", "version.py").read_text() \
+    .split("=", 1)[1].strip().strip("\"")
 now = datetime.utcnow()
 desc_path = pathlib.Path(current_path, "Readme.md")
-long_description = desc_path.open("r").read()
-requirements = os.path.join(current_path, 'requirements.txt')
+long_description = desc_path.read_text(encoding="utf-8")
+requirements = pathlib.Path(current_path, "requirements.txt")
 
 setup(
     name=name,
@@ -20,7 +20,7 @@ setup(
     packages=find_packages(),
     platforms=['POSIX', 'MacOS', 'Windows'],
     python_requires='>=3.7',
-    install_requires=open(requirements).read().splitlines(),
+    install_requires=requirements.read_text().splitlines(),
     entry_points={
         'console_scripts': [
             'sbpack = sbpack.pack:main',
@@ -0,0 +1,28 @@
+import pytest
+
+from sbpack.pack import pack
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "network: needs internet access (GitHub or a Seven Bridges platform), "
+        "deselect with -m 'not network' when offline",
+    )
+
+
+@pytest.fixture(scope="session")
+def packed():
+    """
+    pack() that runs once per document and set of options for the whole
+    session. Tests share the returned dict, so they must not modify it.
+    """
+    cache = {}
+
+    def _packed(cwl_path: str, **kwargs):
+        key = (cwl_path, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = pack(cwl_path, **kwargs)
+        return cache[key]
+
+    return _packed
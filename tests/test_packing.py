@@ -1,70 +1,78 @@
-from sbpack.pack import pack
+import functools
+import http.server
+import os
+import threading
+import urllib.parse
 
+import pytest
 
-def _find(l: list, key: str, val: str):
-    return next(_x for _x in l if _x[key] == val)
+import sbpack.lib
+from sbpack.pack import pack, validate_id, AppIdCheck
+from sbpack.lib import load_linked_file
+from sbpack.schemadef import _inline_type
 
 
-def test_port_normalization():
-    cwl = pack("remote-cwl/wf1.cwl")
-    step_s1 = _find(cwl.get("steps"), "id", "s1")
-    step_in1 = _find(step_s1.get("in"), "id", "in1")
+def _index(l: list, key: str):
+    return {_x[key]: _x for _x in l}
+
+
+def test_port_normalization(packed):
+    cwl = packed("remote-cwl/wf1.cwl")
+    step_s1 = _index(cwl.get("steps"), "id")["s1"]
+    step_in1 = _index(step_s1.get("in"), "id")["in1"]
     assert step_in1["source"] == "in1"
 
-    cwl = pack("wf2.cwl")
-    step_s1 = _find(cwl.get("steps"), "id", "s1")
-    step_in1 = _find(step_s1.get("in"), "id", "in1")
+    cwl = packed("wf2.cwl")
+    step_s1 = _index(cwl.get("steps"), "id")["s1"]
+    step_in1 = _index(step_s1.get("in"), "id")["in1"]
     assert step_in1["source"] == "in1"
 
-    out1 = _find(cwl.get("outputs"), "id", "out1")
+    out1 = _index(cwl.get("outputs"), "id")["out1"]
     assert out1.get("outputSource") == "s2/out1"
 
 
-def test_include():
-    cwl = pack("remote-cwl/tool1.cwl")
+def test_include(packed):
+    cwl = packed("remote-cwl/tool1.cwl")
     assert "arguments" in cwl
     assert isinstance(cwl.get("arguments"), list)
 
-    inline_js_req = _find(
-        cwl.get("requirements"),
-        "class",
-        "InlineJavascriptRequirement"
-    )
+    inline_js_req = \
+        _index(cwl.get("requirements"), "class")["InlineJavascriptRequirement"]
     include_js = inline_js_req.get("expressionLib")
 
     assert isinstance(include_js, list)
     assert "engineers walk into a" in include_js[0]
 
 
-def test_schema_def1():
-    cwl = pack("remote-cwl/tool2.cwl")
-    _type = _find(cwl.get("inputs"), "id", "in1").get("type")
+def test_schema_def1(packed):
+    cwl = packed("remote-cwl/tool2.cwl")
+    _type = _index(cwl.get("inputs"), "id")["in1"].get("type")
     assert isinstance(_type, dict)
     assert _type.get("type") == "array"
 
 
-def test_schema_def2():
-    cwl = pack("wf2.cwl")
-    _type = _find(cwl.get("inputs"), "id", "in2").get("type")
+def test_schema_def2(packed):
+    cwl = packed("wf2.cwl")
+    _type = _index(cwl.get("inputs"), "id")["in2"].get("type")
     assert isinstance(_type, dict)
     assert _type.get("type") == "enum"
 
 
-def test_step_packing():
-    cwl = pack("remote-cwl/wf1.cwl")
-    s1 = _find(cwl.get("steps"), "id", "s1")
+def test_step_packing(packed):
+    cwl = packed("remote-cwl/wf1.cwl")
+    s1 = _index(cwl.get("steps"), "id")["s1"]
     tool2 = s1.get("run")
-    _type = _find(tool2.get("inputs"), "id", "in1").get("type")
+    _type = _index(tool2.get("inputs"), "id")["in1"].get("type")
     assert isinstance(_type, dict)
     assert _type.get("type") == "array"
 
 
-def test_embedded_packing():
-    cwl = pack("workflows/count-lines16-wf.cwl")
+def test_embedded_packing(packed):
+    cwl = packed("workflows/count-lines16-wf.cwl")
 
 
-def test_embedded_packing_with_ids():
-    cwl = pack("workflows/count-lines16-wf.cwl", add_ids=True)
+def test_embedded_packing_with_ids(packed):
+    cwl = packed("workflows/count-lines16-wf.cwl", add_ids=True)
     assert (
             cwl["steps"][0]["run"]["id"]
             == "count-lines16-wf.cwl@step_step1@run"
@@ -79,48 +87,155 @@ def test_embedded_packing_with_ids():
     )
 
 
-def test_step_process_id():
+def test_step_process_id(packed):
     """Workflow step with external "run" reference gets an "id" added."""
-    cwl = pack("workflows/wf2.cwl", add_ids=True)
+    cwl = packed("workflows/wf2.cwl", add_ids=True)
     assert cwl["id"] == "wf2.cwl"
-    s1 = _find(cwl.get("steps"), "id", "s1")
+    s1 = _index(cwl.get("steps"), "id")["s1"]
     assert s1["run"]["id"] == "wf2.cwl@step_s1@clt2.cwl"
 
 
-def test_remote_packing():
-    cwl = pack(
+@pytest.mark.network
+def test_remote_packing(packed):
+    cwl = packed(
         "https://raw.githubusercontent.com/kaushik-work/"
         "sbpack/master/tests/wf2.cwl"
     )
-    s1 = _find(cwl.get("steps"), "id", "s1")
+    s1 = _index(cwl.get("steps"), "id")["s1"]
     wf1 = s1.get("run")
     assert wf1.get("class") == "Workflow"
 
-    tool2 = _find(wf1.get("steps"), "id", "s1").get("run")
-    _type = _find(tool2.get("inputs"), "id", "in1").get("type")
+    tool2 = _index(wf1.get("steps"), "id")["s1"].get("run")
+    _type = _index(tool2.get("inputs"), "id")["in1"].get("type")
     assert isinstance(_type, dict)
     assert _type.get("type") == "array"
 
 
-def test_remote_packing_github_soft_links():
-    cwl = pack(
+@pytest.mark.network
+def test_remote_packing_github_soft_links(packed):
+    cwl = packed(
         "https://raw.githubusercontent.com/rabix/"
         "sbpack/master/tests/workflows/wf5.cwl"
     )
-    s1 = _find(cwl.get("steps"), "id", "s1")
+    s1 = _index(cwl.get("steps"), "id")["s1"]
     tool1 = s1.get("run")
     assert tool1.get("class") == "CommandLineTool"
 
 
-def test_already_packed_graph():
+def test_already_packed_graph(packed):
     """Workflow already packed in a $graph."""
-    cwl = pack("workflows/scatter-wf4.cwl")
+    cwl = packed("workflows/scatter-wf4.cwl")
     assert "inputs" not in cwl
     assert "outputs" not in cwl
     assert "$graph" in cwl
     assert "requirements" not in cwl
 
 
-def test_import_in_type():
-    cwl = pack("workflows/import-in-type.cwl")
+def test_import_in_type(packed):
+    cwl = packed("workflows/import-in-type.cwl")
     assert cwl["inputs"][0]["type"] == ["File", "Directory"]
+
+
+def test_linked_file_cache_returns_copies():
+    """Modifying a loaded file must not leak into later loads of it."""
+    base_url = urllib.parse.urlparse("tools/clt1.cwl")
+    cwl, _ = load_linked_file(base_url, "", is_import=True)
+    cwl["inputs"] = None
+    cwl, _ = load_linked_file(base_url, "", is_import=True)
+    assert cwl["inputs"] is not None
+
+
+def test_validate_id():
+    assert validate_id("user/project/app-id_1") == AppIdCheck.VALID
+    assert validate_id("user/project") == AppIdCheck.PATH_ERROR
+    assert validate_id("user/project/app.id") == AppIdCheck.ILLEGAL_CHARACTERS
+    assert validate_id("user/project/app(1)") == AppIdCheck.ILLEGAL_CHARACTERS
+
+
+def test_shared_link_cache(monkeypatch):
+    loads = []
+    _load_linked_file = sbpack.lib._load_linked_file
+
+    def counting_load(new_url, is_import):
+        loads.append(new_url.geturl())
+        return _load_linked_file(new_url, is_import)
+
+    monkeypatch.setattr(sbpack.lib, "_load_linked_file", counting_load)
+
+    cache = {}
+    cwl1 = pack("workflows/wf1.cwl", cache=cache)
+    assert loads
+    loads.clear()
+    cwl2 = pack("workflows/wf1.cwl", cache=cache)
+    assert loads == []
+    assert [_x["id"] for _x in cwl1["inputs"]] == \
+        [_x["id"] for _x in cwl2["inputs"]]
+
+
+@pytest.fixture
+def http_tests_dir():
+    """
+    Serve the tests directory over http on localhost. Yields the base url,
+    the list of (path, status) pairs of the requests served so far and a
+    dict of server options: set "validators" to False to leave out the
+    Last-Modified header.
+    """
+    served = []
+    options = {"validators": True}
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_request(self, code="-", size="-"):
+            served.append((self.path, int(code)))
+
+        def send_header(self, keyword, value):
+            if keyword == "Last-Modified" and not options["validators"]:
+                return
+            super().send_header(keyword, value)
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(Handler, directory=os.path.dirname(__file__)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", served, options
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_remote_cache_dir(http_tests_dir, tmp_path):
+    base_url, served, _ = http_tests_dir
+    cwl_url = f"{base_url}/remote-cwl/wf1.cwl"
+
+    def _pack():
+        # Start every run with the same inlined type names
+        _inline_type.type_name_uniq_id = 0
+        _inline_type.type_names = set()
+        return pack(cwl_url, cache_dir=tmp_path)
+
+    cwl1 = _pack()
+    assert served and all(code == 200 for _, code in served)
+    cache_files = sorted(tmp_path.glob("*.json"))
+    assert len(cache_files) == len(served)
+
+    served.clear()
+    cwl2 = _pack()
+    assert served and all(code == 304 for _, code in served)
+    assert cwl2 == cwl1
+
+    # A corrupt cache file is fetched again and rewritten
+    cache_files[0].write_text("not json")
+    served.clear()
+    cwl3 = _pack()
+    assert sorted(code for _, code in served).count(200) == 1
+    assert cwl3 == cwl1
+    assert sorted(tmp_path.glob("*.json")) == cache_files
+
+
+def test_remote_cache_dir_needs_validators(http_tests_dir, tmp_path):
+    base_url, served, options = http_tests_dir
+    options["validators"] = False
+    pack(f"{base_url}/remote-cwl/wf1.cwl", cache_dir=tmp_path)
+    assert served
+    assert list(tmp_path.iterdir()) == []
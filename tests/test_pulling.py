@@ -2,7 +2,10 @@ import subprocess
 import pathlib
 import tempfile
 
+import pytest
 
+
+@pytest.mark.network
 def test_pull():
 
     with tempfile.TemporaryDirectory() as td: